@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for the AI Travel Planning Agent
+Run with: gunicorn -c gunicorn_conf.py travel_agent_api:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# The platform router appends one X-Forwarded-For hop; trust it so rate
+# limits see client IPs rather than the router's (override if that changes)
+os.environ.setdefault("TRUSTED_PROXIES", "1")
+
+# Claude calls are I/O bound, so gevent lets each worker hold hundreds of
+# in-flight itinerary requests while the blocking SDK call yields
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gevent"
+worker_connections = 256
+
+keepalive = 75
+
+# Sonnet itineraries can take a minute or more to generate
+timeout = 180
@@ -0,0 +1,167 @@
+"""
+Shared fixtures: fake Anthropic and Redis clients, a fake clock, and a sample trip
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import travel_agent_api
+
+
+def build_message(text="Day 1", model=travel_agent_api.HAIKU_MODEL, input_tokens=100, output_tokens=200):
+    """A Claude Message with just the fields the API reads"""
+    usage = SimpleNamespace(
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cache_creation_input_tokens=0,
+        cache_read_input_tokens=0
+    )
+    return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=usage, model=model)
+
+
+class FakeClock:
+    """Monotonic clock that only moves when a test advances it"""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+    
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeStream:
+    """Context manager mimicking client.messages.stream()"""
+    
+    def __init__(self, messages):
+        self.messages = messages
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    @property
+    def text_stream(self):
+        for chunk in self.messages.stream_chunks:
+            if self.messages.on_chunk:
+                self.messages.on_chunk(chunk)
+            yield chunk
+        if self.messages.stream_error:
+            raise self.messages.stream_error
+    
+    def get_final_message(self):
+        return build_message("".join(self.messages.stream_chunks))
+
+
+class FakeRedis:
+    """Dict-backed stand-in for the few Redis commands the API uses"""
+    
+    def __init__(self):
+        self.data = {}
+    
+    def get(self, key):
+        return self.data.get(key)
+    
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+    
+    def exists(self, key):
+        return int(key in self.data)
+
+
+class FakeBatches:
+    """Stand-in for client.messages.batches"""
+    
+    def __init__(self):
+        self.created = []
+        self.cancelled = []
+        self.ended_at = None
+        self.entries = []
+    
+    def create(self, requests):
+        self.created.append(requests)
+        return SimpleNamespace(id="msgbatch_test")
+    
+    def cancel(self, batch_id):
+        self.cancelled.append(batch_id)
+    
+    def retrieve(self, batch_id):
+        return SimpleNamespace(processing_status="ended", ended_at=self.ended_at)
+    
+    def results(self, batch_id):
+        return self.entries
+
+
+class FakeMessages:
+    """Stand-in for client.messages that records requests instead of hitting Claude"""
+    
+    def __init__(self):
+        self.requests = []
+        self.stream_chunks = ["Day ", "1"]
+        self.stream_error = None
+        self.on_chunk = None
+        self.batches = FakeBatches()
+    
+    @property
+    def calls(self):
+        return len(self.requests) + sum(len(requests) for requests in self.batches.created)
+    
+    def create(self, **params):
+        self.requests.append(params)
+        return build_message()
+    
+    def stream(self, **params):
+        self.requests.append(params)
+        return FakeStream(self)
+
+
+@pytest.fixture(autouse=True)
+def messages(monkeypatch):
+    """Replace the Anthropic client; no test ever reaches Claude"""
+    fake = FakeMessages()
+    fake_client = SimpleNamespace(messages=fake)
+    fake_client.with_options = lambda **options: fake_client
+    monkeypatch.setattr(travel_agent_api, "client", fake_client)
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def isolated_services(monkeypatch):
+    """Disable the Redis cache and rate limits unless a test sets them up"""
+    monkeypatch.setattr(travel_agent_api, "redis_client", None)
+    monkeypatch.setattr(travel_agent_api, "rate_limiter", travel_agent_api.TokenBucketLimiter(0))
+    monkeypatch.setattr(travel_agent_api, "batch_rate_limiter", travel_agent_api.TokenBucketLimiter(0))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(travel_agent_api, "redis_client", fake)
+    return fake
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(travel_agent_api, "clock", fake)
+    return fake
+
+
+@pytest.fixture
+def make_message():
+    return build_message
+
+
+@pytest.fixture
+def client():
+    return travel_agent_api.app.test_client()
+
+
+@pytest.fixture
+def trip():
+    return {"destination": "Lisbon", "travelers": "2 adults", "duration": "2 days"}
@@ -0,0 +1,74 @@
+"""
+Tests for creating Message Batches and reporting their results
+"""
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+import redis
+
+
+@pytest.fixture
+def batches(messages, fake_redis):
+    fake_redis.setex("batch:msgbatch_test", 60, 1)
+    messages.batches.ended_at = datetime(2026, 6, 15, 9, 30, tzinfo=timezone.utc)
+    return messages.batches
+
+
+def succeeded(message):
+    return SimpleNamespace(custom_id="0", result=SimpleNamespace(type="succeeded", message=message))
+
+
+def get_results(client):
+    response = client.get("/api/plan-trips-batch/msgbatch_test")
+    assert response.status_code == 200
+    return response.get_json()["results"]
+
+
+def test_results_are_stamped_with_batch_end_time(client, batches, make_message):
+    batches.entries.append(succeeded(make_message(model="claude-haiku-4-5-20251001", input_tokens=1000, output_tokens=2000)))
+    
+    metadata = get_results(client)["0"]["metadata"]
+    
+    assert metadata["generatedAt"] == "2026-06-15T09:30:00Z"
+    # Haiku 4.5 at half price: (1000 * $1 + 2000 * $5) / 1M / 2
+    assert metadata["estimatedCost"] == "$0.0055"
+
+
+def test_unpriced_model_reports_usage_without_cost(client, batches, make_message):
+    batches.entries.append(succeeded(make_message(model="claude-unknown-1", output_tokens=2000)))
+    
+    metadata = get_results(client)["0"]["metadata"]
+    
+    assert metadata["estimatedCost"] is None
+    assert metadata["outputTokens"] == 2000
+
+
+def test_unknown_batch_ids_are_not_forwarded(client, batches):
+    response = client.get("/api/plan-trips-batch/msgbatch_someone_else")
+    
+    assert response.status_code == 404
+
+
+def test_created_batch_id_is_recorded(client, trip, messages, fake_redis):
+    response = client.post("/api/plan-trips-batch", json=[trip])
+    
+    assert response.status_code == 202
+    assert fake_redis.exists("batch:" + response.get_json()["batchId"])
+
+
+def test_batch_is_cancelled_if_its_id_cannot_be_recorded(monkeypatch, client, trip, messages, fake_redis):
+    def redis_down(*args):
+        raise redis.ConnectionError("redis down")
+    monkeypatch.setattr(fake_redis, "setex", redis_down)
+    
+    response = client.post("/api/plan-trips-batch", json=[trip])
+    
+    assert response.status_code == 503
+    assert messages.batches.cancelled == ["msgbatch_test"]
+
+
+def test_batches_require_redis(client, trip):
+    assert client.post("/api/plan-trips-batch", json=[trip]).status_code == 503
+    assert client.get("/api/plan-trips-batch/msgbatch_test").status_code == 503
@@ -0,0 +1,60 @@
+"""
+Tests for queued itinerary jobs when Redis or the broker is unavailable
+"""
+
+import pytest
+import redis
+from kombu.exceptions import OperationalError
+
+import travel_agent_api
+
+
+@pytest.fixture(autouse=True)
+def jobs_enabled(monkeypatch):
+    monkeypatch.setattr(travel_agent_api, "REDIS_URL", "redis://127.0.0.1:6390/0")
+
+
+def raise_error(error):
+    def fail(*args, **kwargs):
+        raise error
+    return fail
+
+
+def assert_unavailable(response):
+    assert response.status_code == 503
+    assert response.get_json()["message"].startswith("Background job service is unavailable")
+
+
+@pytest.mark.parametrize("error", [
+    OperationalError("broker down"),
+    redis.ConnectionError("redis down")
+])
+def test_enqueue_failure_returns_json_503(monkeypatch, client, trip, error):
+    monkeypatch.setattr(travel_agent_api.generate_itinerary_task, "delay", raise_error(error))
+    
+    assert_unavailable(client.post("/api/plan-trip?async=1", json=trip))
+
+
+def test_result_consumer_failure_returns_json_503(monkeypatch, client, trip):
+    # Celery's Redis result consumer wraps connection errors in RuntimeError
+    error = RuntimeError("Retry limit exceeded")
+    error.__cause__ = redis.ConnectionError("redis down")
+    monkeypatch.setattr(travel_agent_api.generate_itinerary_task, "delay", raise_error(error))
+    
+    assert_unavailable(client.post("/api/plan-trip?async=1", json=trip))
+
+
+def test_status_failure_returns_json_503(monkeypatch, client):
+    monkeypatch.setattr(travel_agent_api.celery.AsyncResult, "successful", raise_error(redis.ConnectionError("down")))
+    
+    assert_unavailable(client.get("/api/plan-trip/job-id"))
+
+
+def test_cache_hit_returns_finished_job_shape(monkeypatch, client, trip):
+    cached = {"success": True, "itinerary": "Day 1", "metadata": {}}
+    monkeypatch.setattr(travel_agent_api, "get_cached_itinerary", lambda key: cached)
+    
+    response = client.post("/api/plan-trip?async=1", json=trip)
+    
+    assert response.status_code == 200
+    assert response.get_json() == {"status": "done", "result": {**cached, "metadata": {"cached": True}}}
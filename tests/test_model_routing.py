@@ -0,0 +1,26 @@
+"""
+Tests for routing trips between Haiku and Sonnet
+"""
+
+import pytest
+
+from travel_agent_api import HAIKU_MODEL, SONNET_MODEL, choose_model
+
+
+@pytest.mark.parametrize("duration", ["3 days", "3-day trip", "3day", "2 Nights", "2-night stay", "1 day"])
+def test_short_trips_go_to_haiku(duration):
+    assert choose_model({"duration": duration}) == (HAIKU_MODEL, 3000)
+
+
+@pytest.mark.parametrize("duration", ["4 days", "4-day trip", "1 week", "2-week holiday", "a long weekend", ""])
+def test_longer_or_unparsed_trips_go_to_sonnet(duration):
+    assert choose_model({"duration": duration}) == (SONNET_MODEL, 8000)
+
+
+def test_more_than_three_interests_go_to_sonnet():
+    assert choose_model({"duration": "2 days", "interests": ["a", "b", "c"]})[0] == HAIKU_MODEL
+    assert choose_model({"duration": "2 days", "interests": ["a", "b", "c", "d"]})[0] == SONNET_MODEL
+
+
+def test_special_requests_go_to_sonnet():
+    assert choose_model({"duration": "2 days", "specialRequests": "Wheelchair access"})[0] == SONNET_MODEL
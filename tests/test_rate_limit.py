@@ -0,0 +1,177 @@
+"""
+Tests for the per-client token bucket rate limiting
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from kombu.exceptions import OperationalError
+
+import travel_agent_api
+from travel_agent_api import TokenBucketLimiter
+
+SECOND = 1_000_000_000
+
+
+@pytest.fixture
+def limiters(monkeypatch):
+    single = TokenBucketLimiter(2)
+    batch = TokenBucketLimiter(5)
+    monkeypatch.setattr(travel_agent_api, "rate_limiter", single)
+    monkeypatch.setattr(travel_agent_api, "batch_rate_limiter", batch)
+    return single, batch
+
+
+def test_bucket_allows_capacity_then_rejects():
+    limiter = TokenBucketLimiter(3)
+    assert [limiter.take("a", now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.take("a", now=0) == 20
+
+
+def test_bucket_refills_over_time():
+    limiter = TokenBucketLimiter(60)
+    assert limiter.take("a", cost=60, now=0) == 0
+    assert limiter.take("a", now=0) == 1
+    assert limiter.take("a", now=SECOND) == 0
+
+
+def test_bucket_charges_cost():
+    limiter = TokenBucketLimiter(10)
+    assert limiter.take("a", cost=8, now=0) == 0
+    assert limiter.take("a", cost=3, now=0) == 6
+    assert limiter.take("a", cost=2, now=0) == 0
+
+
+def test_buckets_are_per_key():
+    limiter = TokenBucketLimiter(1)
+    assert limiter.take("a", now=0) == 0
+    assert limiter.take("b", now=0) == 0
+    assert limiter.take("a", now=0) > 0
+
+
+def test_refund_returns_tokens_up_to_capacity():
+    limiter = TokenBucketLimiter(2)
+    limiter.take("a", cost=2, now=0)
+    limiter.refund("a")
+    limiter.refund("a", cost=5)
+    
+    assert limiter.buckets["a"][0] == 2
+
+
+def test_zero_capacity_disables_limit():
+    limiter = TokenBucketLimiter(0)
+    assert all(limiter.take("a", now=0) == 0 for _ in range(100))
+
+
+def test_table_is_bounded_and_evicts_least_recently_used():
+    limiter = TokenBucketLimiter(1, max_keys=3)
+    for key in ("a", "b", "c"):
+        limiter.take(key, now=0)
+    limiter.take("a", now=0)  # Touch a so b becomes the oldest
+    limiter.take("d", now=0)
+    
+    assert list(limiter.buckets) == ["c", "a", "d"]
+    # b was forgotten, so it starts again with a full bucket
+    assert limiter.take("b", now=0) == 0
+
+
+def test_plan_trip_rejects_when_bucket_is_empty(client, trip, messages, limiters):
+    statuses = [client.post("/api/plan-trip?stream=0", json=trip).status_code for _ in range(3)]
+    
+    assert statuses == [200, 200, 429]
+    assert messages.calls == 2
+
+
+def test_forwarded_for_header_does_not_change_bucket(client, trip, messages, limiters):
+    for _ in range(2):
+        client.post("/api/plan-trip?stream=0", json=trip)
+    
+    response = client.post("/api/plan-trip?stream=0", json=trip, headers={"X-Forwarded-For": "1.2.3.4"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_invalid_bodies_do_not_spend_tokens(client, trip, messages, limiters):
+    for _ in range(5):
+        assert client.post("/api/plan-trip", json={"destination": "Lisbon"}).status_code == 400
+    
+    assert client.post("/api/plan-trip?stream=0", json=trip).status_code == 200
+
+
+def test_cache_hits_do_not_spend_tokens(client, trip, messages, limiters, monkeypatch):
+    monkeypatch.setattr(travel_agent_api, "get_cached_itinerary", lambda key: {
+        "success": True,
+        "itinerary": "Day 1",
+        "metadata": {}
+    })
+    
+    for _ in range(5):
+        assert client.post("/api/plan-trip?stream=0", json=trip).status_code == 200
+    assert messages.calls == 0
+
+
+def test_batch_charges_one_token_per_trip(client, trip, messages, limiters, fake_redis):
+    assert client.post("/api/plan-trips-batch", json=[trip] * 4).status_code == 202
+    
+    response = client.post("/api/plan-trips-batch", json=[trip] * 2)
+    assert response.status_code == 429
+    assert messages.calls == 4
+
+
+def test_batch_larger_than_limit_is_rejected(client, trip, messages, limiters, fake_redis):
+    response = client.post("/api/plan-trips-batch", json=[trip] * 6)
+    
+    assert response.status_code == 400
+    assert messages.calls == 0
+
+
+def test_async_without_job_queue_does_not_spend_tokens(client, trip, messages, limiters):
+    statuses = [client.post("/api/plan-trip?async=1", json=trip).status_code for _ in range(3)]
+    
+    assert statuses == [503, 503, 503]
+    assert client.post("/api/plan-trip?stream=0", json=trip).status_code == 200
+
+
+def test_failed_enqueue_refunds_token(client, trip, messages, limiters, monkeypatch):
+    def broker_down(data):
+        raise OperationalError("broker down")
+    monkeypatch.setattr(travel_agent_api, "REDIS_URL", "redis://127.0.0.1:6390/0")
+    monkeypatch.setattr(travel_agent_api.generate_itinerary_task, "delay", broker_down)
+    
+    statuses = [client.post("/api/plan-trip?async=1", json=trip).status_code for _ in range(3)]
+    
+    assert statuses == [503, 503, 503]
+    assert client.post("/api/plan-trip?stream=0", json=trip).status_code == 200
+
+
+def test_enqueued_job_spends_token(client, trip, messages, limiters, monkeypatch):
+    monkeypatch.setattr(travel_agent_api, "REDIS_URL", "redis://127.0.0.1:6390/0")
+    monkeypatch.setattr(travel_agent_api.generate_itinerary_task, "delay", lambda data: SimpleNamespace(id="job-id"))
+    
+    statuses = [client.post("/api/plan-trip?async=1", json=trip).status_code for _ in range(3)]
+    
+    assert statuses == [202, 202, 429]
+
+
+@pytest.fixture
+def behind_one_proxy(monkeypatch):
+    monkeypatch.setattr(travel_agent_api.app.wsgi_app, "x_for", 1)
+
+
+def test_trusted_proxy_hop_gives_each_client_a_bucket(client, trip, messages, limiters, behind_one_proxy):
+    def post(forwarded_for):
+        return client.post("/api/plan-trip?stream=0", json=trip, headers={"X-Forwarded-For": forwarded_for}).status_code
+    
+    assert [post("203.0.113.1") for _ in range(3)] == [200, 200, 429]
+    # Same proxy peer, different client: a fresh bucket
+    assert post("203.0.113.2") == 200
+
+
+def test_trusted_proxy_hop_ignores_client_supplied_entries(client, trip, messages, limiters, behind_one_proxy):
+    # The router appends the real client IP after whatever the client sent
+    statuses = [
+        client.post("/api/plan-trip?stream=0", json=trip, headers={"X-Forwarded-For": f"10.0.0.{i}, 203.0.113.1"}).status_code
+        for i in range(3)
+    ]
+    
+    assert statuses == [200, 200, 429]
@@ -0,0 +1,61 @@
+"""
+Tests for sampled request logging
+"""
+
+import pytest
+
+import travel_agent_api
+
+
+@pytest.fixture
+def logged(monkeypatch, clock):
+    lines = []
+    monkeypatch.setattr(travel_agent_api, "log_request_line", lambda *args: lines.append(args + (clock(),)))
+    return lines
+
+
+def post_stream(client, trip):
+    response = client.post("/api/plan-trip", json=trip)
+    response.get_data()
+    response.close()
+    return response
+
+
+def test_streamed_request_is_logged_after_the_body(client, trip, messages, clock, logged):
+    messages.on_chunk = lambda chunk: clock.advance(1)
+    
+    response = post_stream(client, trip)
+    
+    assert response.status_code == 200
+    [(method, path, status, started, logged_at)] = logged
+    assert (method, path, status) == ("POST", "/api/plan-trip", 200)
+    # Logged once both chunks were generated, not when the response was built
+    assert logged_at - started == 2
+
+
+def test_failed_stream_is_logged_as_error(client, trip, messages, logged):
+    messages.stream_chunks = ["Day "]
+    messages.stream_error = RuntimeError("boom")
+    
+    response = post_stream(client, trip)
+    
+    assert response.status_code == 200
+    assert b'"statusCode":500' in response.get_data()
+    assert [line[2] for line in logged] == [500]
+
+
+def test_non_streamed_request_is_logged_once(client, logged):
+    client.post("/api/plan-trip", json={"destination": "Lisbon"})
+    
+    assert [line[2] for line in logged] == [400]
+
+
+@pytest.mark.parametrize("status, logged", [(200, False), (400, False), (429, False), (500, True), (504, True)])
+def test_only_server_errors_bypass_sampling(monkeypatch, clock, status, logged):
+    records = []
+    monkeypatch.setattr(travel_agent_api, "LOG_SAMPLE_RATE", 0)
+    monkeypatch.setattr(travel_agent_api.logger, "log", lambda level, event, extra: records.append(extra["fields"]))
+    
+    travel_agent_api.log_request_line("POST", "/api/plan-trip", status, clock())
+    
+    assert bool(records) == logged
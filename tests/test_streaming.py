@@ -0,0 +1,94 @@
+"""
+Tests for the NDJSON itinerary stream
+"""
+
+import gzip
+import threading
+
+import orjson
+import pytest
+
+import travel_agent_api
+
+
+@pytest.fixture
+def flush_after(monkeypatch):
+    def configure(chars, seconds):
+        monkeypatch.setattr(travel_agent_api, "STREAM_FLUSH_CHARS", chars)
+        monkeypatch.setattr(travel_agent_api, "STREAM_FLUSH_INTERVAL", seconds)
+    return configure
+
+
+def stream_lines(client, trip):
+    response = client.post("/api/plan-trip", json=trip, buffered=False)
+    return response, (orjson.loads(line) for line in response.iter_encoded())
+
+
+def test_deltas_are_coalesced_and_remainder_flushed_at_end(client, trip, messages, flush_after):
+    flush_after(chars=4, seconds=60)
+    messages.stream_chunks = list("ABCDEF")
+    
+    response, lines = stream_lines(client, trip)
+    
+    # First delta goes out at once, then 4-character batches, then the rest
+    assert [line.get("delta") for line in lines] == ["A", "BCDE", "F", None]
+    response.close()
+
+
+def test_pending_text_is_flushed_while_the_model_stalls(client, trip, messages, flush_after):
+    flush_after(chars=256, seconds=0.01)
+    messages.stream_chunks = ["A", "B", "C"]
+    resume = threading.Event()
+    messages.on_chunk = lambda chunk: chunk == "C" and resume.wait(5)
+    
+    response, lines = stream_lines(client, trip)
+    
+    assert next(lines) == {"delta": "A"}
+    # Sent on the flush timer, before the stalled "C" arrives
+    assert next(lines) == {"delta": "B"}
+    assert not resume.is_set()
+    resume.set()
+    assert next(lines) == {"delta": "C"}
+    assert "metadata" in next(lines)
+    response.close()
+
+
+@pytest.fixture
+def latency_beta(monkeypatch):
+    monkeypatch.setattr(travel_agent_api, "LATENCY_OPTIMIZED_BETA", "latency-beta")
+
+
+def sent_headers(messages):
+    return [params.get("extra_headers") for params in messages.requests]
+
+
+def test_latency_beta_is_sent_for_streams(client, trip, messages, latency_beta):
+    client.post("/api/plan-trip", json=trip).get_data()
+    client.post("/api/plan-trip", json={**trip, "fast": False, "noCache": True}).get_data()
+    
+    assert sent_headers(messages) == [{"anthropic-beta": "latency-beta"}, None]
+
+
+def test_latency_beta_is_not_sent_for_non_interactive_calls(client, trip, messages, latency_beta):
+    client.post("/api/plan-trip?stream=0", json=trip)
+    travel_agent_api.generate_itinerary_task(trip)
+    
+    assert sent_headers(messages) == [None, None]
+
+
+def test_gzipped_stream_decompresses_to_ndjson(client, trip):
+    response = client.post("/api/plan-trip", json=trip, headers={"Accept-Encoding": "gzip"})
+    
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    lines = [orjson.loads(line) for line in gzip.decompress(response.get_data()).splitlines()]
+    assert [line.get("delta") for line in lines] == ["Day ", "1", None]
+    assert "metadata" in lines[-1]
+
+
+@pytest.mark.parametrize("headers", [{}, {"Accept-Encoding": "gzip;q=0"}, {"Accept-Encoding": "identity"}])
+def test_stream_is_uncompressed_unless_gzip_is_accepted(client, trip, headers):
+    response = client.post("/api/plan-trip", json=trip, headers=headers)
+    
+    assert "Content-Encoding" not in response.headers
+    assert orjson.loads(response.get_data().splitlines()[0]) == {"delta": "Day "}
@@ -3,83 +3,190 @@ AI Travel Planning Agent - Real Version
 Uses Claude AI to generate custom travel itineraries based on user input
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from anthropic import Anthropic
+from flask import Flask, Response, g, request, jsonify, stream_with_context, url_for
+from flask_compress import Compress
+from anthropic import Anthropic, APITimeoutError, DefaultHttpxClient, NotFoundError
+from celery import Celery
+from kombu.exceptions import OperationalError
+import atexit
+import fastjsonschema
+import hashlib
+import httpx2
+import logging
+import math
+import orjson
 import os
-from datetime import datetime
+import queue
+import random
+import re
+import redis
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
 
-# Initialize Anthropic client
-client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+# Number of X-Forwarded-For hops added by proxies we actually sit behind.
+# gunicorn_conf.py defaults it to 1 for the platform router in front of the
+# Procfile deployment; with 0 (the local dev server) request.remote_addr is
+# the socket peer and client-supplied headers are ignored.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("TRUSTED_PROXIES", 0)))
 
-@app.route('/')
-def home():
-    """Health check endpoint"""
-    return jsonify({
-        "status": "online",
-        "service": "AI Travel Planning Agent",
-        "version": "1.0",
-        "endpoints": {
-            "plan_trip": "/api/plan-trip"
-        }
-    })
+# Compress JSON responses; NDJSON streams are gzipped separately by
+# gzip_stream() since flask-compress buffers streamed output
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 500
+app.config["COMPRESS_STREAMS"] = False
+Compress(app)
 
-@app.route('/api/plan-trip', methods=['POST'])
-def plan_trip():
-    """
-    Generate a custom travel itinerary using Claude AI
+class JsonLineHandler(logging.Handler):
+    """Write each log record to stdout as one orjson-encoded line"""
     
-    Expected JSON body:
-    {
-        "destination": "Greece",
-        "travelers": "Family of 4 (2 adults, 2 young adults)",
-        "duration": "7 days",
-        "dates": "June 15-22, 2026",
-        "budget": "$8,000-10,000",
-        "departureCity": "Austin, Texas",
-        "interests": ["history", "food", "beaches"],
-        "pace": "relaxed",
-        "specialRequests": "Family-friendly, love culture"
-    }
+    def emit(self, record):
+        try:
+            entry = {"ts": record.created, "level": record.levelname, "event": record.getMessage()}
+            entry.update(getattr(record, "fields", {}))
+            sys.stdout.buffer.write(orjson.dumps(entry) + b"\n")
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+# Request handlers only enqueue log records; a background thread does the
+# serialization and the stdout write
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, JsonLineHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("travel_agent")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+
+# Werkzeug's per-request lines would bypass the queue; errors are logged below
+logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+# Fraction of requests logged, 4xx included so a flood of bad or throttled
+# requests can't swamp the log queue; 5xx responses are always logged
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+
+# Clock for request durations, module-level so tests can substitute their own
+clock = time.monotonic
+
+class TokenBucketLimiter:
     """
+    Per-key token buckets refilled continuously on the monotonic clock
     
-    # Validate request
-    if not request.is_json:
-        return jsonify({
-            "error": True,
-            "message": "Content-Type must be application/json",
-            "statusCode": 400
-        }), 400
+    Buckets live in an OrderedDict kept in least-recently-used order and the
+    oldest one is evicted once max_keys is reached, so memory and per-call
+    work stay bounded no matter how many clients show up.
+    """
     
-    data = request.get_json()
+    def __init__(self, capacity, per_seconds=60, max_keys=10000):
+        self.capacity = capacity
+        self.refill_per_ns = capacity / (per_seconds * 1e9)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
     
-    # Validate required fields
-    required_fields = ['destination', 'travelers', 'duration']
-    missing_fields = [field for field in required_fields if not data.get(field)]
+    def take(self, key, cost=1, now=None):
+        """Spend cost tokens; return 0 if allowed, else seconds until retry"""
+        if self.capacity <= 0:
+            return 0  # A capacity of 0 disables the limit
+        
+        now = time.monotonic_ns() if now is None else now
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.refill_per_ns)
+            
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        
+        if allowed:
+            return 0
+        return max(1, math.ceil((cost - tokens) / self.refill_per_ns / 1e9))
     
-    if missing_fields:
-        return jsonify({
-            "error": True,
-            "message": f"Missing required fields: {', '.join(missing_fields)}",
-            "statusCode": 400
-        }), 400
-    
-    # Extract data with defaults
-    destination = data.get('destination')
-    travelers = data.get('travelers')
-    duration = data.get('duration')
-    dates = data.get('dates', 'Flexible')
-    budget = data.get('budget', 'Moderate budget')
-    departure_city = data.get('departureCity', 'United States')
-    interests = ', '.join(data.get('interests', ['sightseeing', 'culture', 'food']))
-    pace = data.get('pace', 'moderate')
-    special_requests = data.get('specialRequests', '')
-    
-    # Build the system prompt
-    system_prompt = """You are an expert travel planning AI agent with 20+ years of experience in creating personalized travel itineraries. You have deep knowledge of destinations worldwide, cultural insights, logistics optimization, and budget management.
+    def refund(self, key, cost=1):
+        """Return tokens spent on work that never happened"""
+        with self.lock:
+            if key in self.buckets:
+                tokens, last = self.buckets[key]
+                self.buckets[key] = (min(self.capacity, tokens + cost), last)
+
+# Token buckets per client IP, charged only for work that reaches Claude: one
+# token per itinerary, and one token per trip from a separate, larger bucket
+# for batches. Buckets are per worker process, so the effective limit scales
+# with the worker count. Set a limit to 0 to disable it.
+#
+# Client IPs come from X-Forwarded-For only when TRUSTED_PROXIES matches the
+# proxies in front of the app. Set too low, every client shares the proxy's
+# bucket; set too high, clients can spoof their way into fresh buckets.
+rate_limiter = TokenBucketLimiter(int(os.environ.get("RATE_LIMIT_PER_MINUTE", 10)))
+batch_rate_limiter = TokenBucketLimiter(int(os.environ.get("RATE_LIMIT_BATCH_TRIPS_PER_MINUTE", 100)))
+
+# Per-phase timeouts so a stalled call fails fast instead of pinning a
+# worker. Read allows for a full non-streamed Sonnet itinerary, which sends
+# no bytes until generation finishes.
+API_TIMEOUT = httpx2.Timeout(connect=3.0, read=150.0, write=10.0, pool=5.0)
+
+# Shared HTTP/2 connection pool so repeat calls reuse the TCP+TLS session
+http_client = DefaultHttpxClient(
+    http2=True,
+    limits=httpx2.Limits(max_keepalive_connections=64, max_connections=128, keepalive_expiry=60.0),
+    timeout=API_TIMEOUT
+)
+
+# Initialize Anthropic client. Retries suit streamed calls, which fail
+# before any output is generated; see generate_itinerary for blocking calls.
+client = Anthropic(
+    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+    http_client=http_client,
+    timeout=API_TIMEOUT,
+    max_retries=2
+)
+
+# Optional Redis cache for complete itineraries; disabled without REDIS_URL
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+ITINERARY_CACHE_TTL = 3600
+
+# Batch ids created by plan_trips_batch, so the status endpoint won't read
+# other batches in the same Anthropic org; results are kept for 29 days
+BATCH_KEY_PREFIX = "batch:"
+BATCH_RECORD_TTL = 29 * 24 * 3600
+
+# Background itinerary jobs (?async=1) share the same Redis as broker and
+# result store; run consumers with: celery -A travel_agent_api.celery worker
+celery = Celery(__name__, broker=REDIS_URL, backend=REDIS_URL)
+celery.conf.result_expires = ITINERARY_CACHE_TTL
+# Fail fast when Redis is down instead of retrying for ~20s per request
+celery.conf.result_backend_transport_options = {
+    "retry_policy": {"max_retries": 2, "interval_start": 0, "interval_step": 0.5, "interval_max": 1}
+}
+
+def job_service_down(error):
+    """True if a Celery call failed because Redis or the broker is unreachable"""
+    if isinstance(error, (OperationalError, redis.RedisError)):
+        return True
+    # The Redis result consumer re-raises connection errors as RuntimeError
+    return isinstance(error, RuntimeError) and isinstance(error.__cause__, redis.RedisError)
+
+# Anthropic beta flag enabling latency-optimized inference for streamed
+# requests; left unset, requests use the default inference mode
+LATENCY_OPTIMIZED_BETA = os.environ.get("ANTHROPIC_LATENCY_BETA")
+
+# Static prompts live at module level so their bytes are identical across
+# requests - Anthropic prompt cache keys are exact-match on the prefix.
+SYSTEM_PROMPT = """You are an expert travel planning AI agent with 20+ years of experience in creating personalized travel itineraries. You have deep knowledge of destinations worldwide, cultural insights, logistics optimization, and budget management.
 
 Your approach is:
 - Thorough and detail-oriented
@@ -97,20 +204,8 @@ You create comprehensive travel plans that include:
 - Transportation logistics
 - Budget breakdown
 - Pro tips and local insights"""
-    
-    # Build the user prompt
-    user_prompt = f"""Create a comprehensive, personalized travel itinerary with the following parameters:
 
-**Trip Overview:**
-- Destination: {destination}
-- Travelers: {travelers}
-- Duration: {duration}
-- Travel Dates: {dates}
-- Budget: {budget}
-- Departing From: {departure_city}
-- Interests: {interests}
-- Preferred Pace: {pace}
-{f"- Special Requests: {special_requests}" if special_requests else ""}
+TRIP_DELIVERABLES = """Create a comprehensive, personalized travel itinerary for the trip described in the Trip Overview that follows these instructions.
 
 **Required Deliverables:**
 
@@ -190,77 +285,751 @@ You create comprehensive travel plans that include:
 - Include pro tips that show local knowledge
 
 Generate a complete, professional travel plan that someone could actually use to book and enjoy this trip!"""
+
+# Content blocks for the cached prefix are built once at import time; only
+# the Trip Overview block is allocated per request.
+#
+# Anthropic only caches a prefix once it reaches the model's minimum length
+# (1024 tokens for Sonnet 4.5, 4096 for Haiku 4.5). The system prompt plus
+# deliverables are ~800 tokens today, so these cache_control markers are
+# ignored - no cache reads happen - until the static prompt grows past that
+# minimum. cacheReadInputTokens in the response metadata shows whether it is.
+SYSTEM_BLOCKS = [
+    {
+        "type": "text",
+        "text": SYSTEM_PROMPT,
+        "cache_control": {"type": "ephemeral"}
+    }
+]
+
+DELIVERABLES_BLOCK = {
+    "type": "text",
+    "text": TRIP_DELIVERABLES,
+    "cache_control": {"type": "ephemeral"}
+}
+
+REQUIRED_FIELDS = ['destination', 'travelers', 'duration']
+
+MAX_BATCH_SIZE = 100
+
+TRIP_REQUEST_SCHEMA = {
+    "type": "object",
+    "required": REQUIRED_FIELDS,
+    "properties": {
+        "destination": {"type": "string", "minLength": 1},
+        "travelers": {"type": "string", "minLength": 1},
+        "duration": {"type": "string", "minLength": 1},
+        "dates": {"type": "string"},
+        "budget": {"type": "string"},
+        "departureCity": {"type": "string"},
+        "interests": {"type": "array", "items": {"type": "string"}},
+        "pace": {"type": "string"},
+        "specialRequests": {"type": "string"},
+        "noCache": {"type": "boolean"},
+        "fast": {"type": "boolean"}
+    }
+}
+
+validate_trip_request = fastjsonschema.compile(TRIP_REQUEST_SCHEMA)
+
+validate_batch_request = fastjsonschema.compile({
+    "type": "array",
+    "minItems": 1,
+    "maxItems": MAX_BATCH_SIZE,
+    "items": TRIP_REQUEST_SCHEMA
+})
+
+# Streamed deltas are buffered until this many characters have accumulated
+# or the oldest buffered delta is this many seconds old, so each yield (one
+# send() syscall) carries several tokens
+STREAM_FLUSH_CHARS = 256
+STREAM_FLUSH_INTERVAL = 0.05
+
+def json_response(payload, status=200):
+    """Serialize a payload with orjson, bypassing Flask's JSON provider"""
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+# Fixed error bodies are serialized once at import time as (body, status)
+def static_error(message, status, **extra):
+    return orjson.dumps({"error": True, "message": message, "statusCode": status, **extra}), status
+
+ERR_NOT_JSON = static_error("Content-Type must be application/json", 400)
+ERR_INVALID_JSON = static_error("Request body must be valid JSON", 400)
+ERR_JOBS_DISABLED = static_error("Background jobs are not configured (REDIS_URL is not set)", 503)
+ERR_BATCHES_DISABLED = static_error("Batch jobs are not configured (REDIS_URL is not set)", 503)
+ERR_JOBS_UNAVAILABLE = static_error("Background job service is unavailable. Please retry later.", 503)
+ERR_TIMEOUT = static_error("Timed out waiting for the itinerary. Please retry the request.", 504, retryable=True)
+ERR_RATE_LIMITED = static_error("Too many itinerary requests. Please retry later.", 429)
+ERR_NOT_FOUND = static_error("Endpoint not found. Use POST /api/plan-trip", 404)
+ERR_METHOD_NOT_ALLOWED = static_error("Method not allowed. Use POST request.", 405)
+
+def error_response(error):
+    """Build a response from a precomputed static_error()"""
+    body, status = error
+    return Response(body, status=status, mimetype="application/json")
+
+def gzip_stream(chunks):
+    """Gzip a streamed body, sync-flushing so each chunk reaches the client now"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def read_claude_stream(request_params, events, closed):
+    """Push a Claude stream's text deltas, then its final message, onto events"""
+    try:
+        with client.messages.stream(**request_params) as stream:
+            for chunk in stream.text_stream:
+                if closed.is_set():
+                    return  # The client went away; leaving the block closes the stream
+                events.put(("text", chunk))
+            events.put(("done", stream.get_final_message()))
+    except Exception as e:
+        events.put(("error", e))
+
+def coalesced_text(request_params, final):
+    """
+    Stream an itinerary's text in batches, storing the final message in final
+    
+    The first delta is sent at once; after that deltas are joined until
+    STREAM_FLUSH_CHARS is reached or STREAM_FLUSH_INTERVAL has passed. The
+    stream is read on its own (green, under gevent) thread so buffered text
+    is flushed on time even while the model stalls between deltas.
+    """
+    events = queue.Queue()
+    closed = threading.Event()
+    threading.Thread(target=read_claude_stream, args=(request_params, events, closed), daemon=True).start()
     
+    pending = []
+    pending_chars = 0
+    deadline = None  # When the oldest pending delta is due; None while empty
+    sent_first = False
     try:
-        # Call Claude API with extended timeout
-        message = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=8000,  # Longer for detailed itinerary
-            temperature=0.8,  # Slightly creative for variety
-            system=system_prompt,
-            messages=[
-                {
-                    "role": "user",
-                    "content": user_prompt
-                }
-            ]
+        while True:
+            try:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                kind = "flush"
+            
+            if kind == "text":
+                pending.append(value)
+                pending_chars += len(value)
+                if deadline is None:
+                    deadline = time.monotonic() + STREAM_FLUSH_INTERVAL
+                if sent_first and pending_chars < STREAM_FLUSH_CHARS:
+                    continue
+            
+            if pending:
+                yield "".join(pending)
+                pending = []
+                pending_chars = 0
+                deadline = None
+                sent_first = True
+            
+            if kind == "done":
+                final["message"] = value
+                return
+            if kind == "error":
+                raise value
+    finally:
+        closed.set()
+
+def read_json_body():
+    """Parse the request body, returning (data, None) or (None, error response)"""
+    if not request.is_json:
+        return None, error_response(ERR_NOT_JSON)
+    
+    try:
+        return orjson.loads(request.get_data()), None
+    except orjson.JSONDecodeError:
+        return None, error_response(ERR_INVALID_JSON)
+
+SONNET_MODEL = "claude-sonnet-4-5-20250929"
+HAIKU_MODEL = "claude-haiku-4-5"
+
+# Nano-dollars per token: (input, output, cache write, cache read). Integer
+# rates keep the sum exact; cache reads bill at 0.1x and writes at 1.25x.
+PRICES = {
+    SONNET_MODEL: (3000, 15000, 3750, 300),
+    HAIKU_MODEL: (1000, 5000, 1250, 100)
+}
+
+# Matches "3 days", "3-day", "2 nights", "1 week", ...
+DURATION_PATTERN = re.compile(r"(\d+)[\s-]*(day|night|week)", re.IGNORECASE)
+
+DEFAULT_INTERESTS = ('sightseeing', 'culture', 'food')
+
+def choose_model(data):
+    """
+    Pick the model and output budget for a trip request
+    
+    Short trips (3 days or less) with few interests and no special requests
+    go to Haiku; everything else, including durations we can't parse, gets
+    Sonnet with the full output budget.
+    """
+    match = DURATION_PATTERN.search(str(data.get('duration', '')))
+    if match:
+        days = int(match.group(1)) * (7 if match.group(2).lower() == 'week' else 1)
+    else:
+        days = None
+    
+    interests = data.get('interests', DEFAULT_INTERESTS)
+    
+    if days is not None and days <= 3 and len(interests) <= 3 and not data.get('specialRequests'):
+        return HAIKU_MODEL, 3000
+    return SONNET_MODEL, 8000
+
+def itinerary_cache_key(data):
+    """Hash the canonicalized request body into a Redis key"""
+    body = {key: value for key, value in data.items() if key not in ('noCache', 'fast')}
+    return "itin:" + hashlib.blake2b(orjson.dumps(body, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def get_cached_itinerary(key):
+    """Return a previously generated response, or None on a miss"""
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(key)
+    except redis.RedisError:
+        # The cache is an optimization; fall through to Claude
+        return None
+    return orjson.loads(cached) if cached else None
+
+def cache_itinerary(key, response):
+    """Store a generated response for identical follow-up requests"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, ITINERARY_CACHE_TTL, orjson.dumps(response))
+    except redis.RedisError:
+        pass
+
+def iso_utc(t=None):
+    """A UTC struct_time (default: now) as RFC 3339, e.g. 2026-06-15T09:30:00Z"""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime() if t is None else t)
+
+def usage_metadata(usage, model, batch=False, generated_at=None):
+    """Build the response metadata block from a Claude usage object"""
+    input_tokens = usage.input_tokens
+    output_tokens = usage.output_tokens
+    cache_creation_tokens = usage.cache_creation_input_tokens or 0
+    cache_read_tokens = usage.cache_read_input_tokens or 0
+    
+    # Responses may name the dated snapshot behind an alias like claude-haiku-4-5
+    rates = PRICES.get(model) or next((rates for name, rates in PRICES.items() if model.startswith(name)), None)
+    if rates is None:
+        # Unpriced model: report usage without guessing at a cost
+        estimated_cost = None
+    else:
+        input_rate, output_rate, cache_write_rate, cache_read_rate = rates
+        cost_nanos = (
+            input_tokens * input_rate
+            + output_tokens * output_rate
+            + cache_creation_tokens * cache_write_rate
+            + cache_read_tokens * cache_read_rate
         )
+        if batch:
+            cost_nanos //= 2  # Message Batches bill at 50%
+        estimated_cost = f"${cost_nanos / 1_000_000_000:.4f}"
+    
+    return {
+        "generatedAt": generated_at or iso_utc(),
+        "inputTokens": input_tokens,
+        "outputTokens": output_tokens,
+        "cacheCreationInputTokens": cache_creation_tokens,
+        "cacheReadInputTokens": cache_read_tokens,
+        "estimatedCost": estimated_cost,
+        "model": model
+    }
+
+# Per-request trip parameters (kept out of the cached prefix), filled with
+# %-formatting from a template built once
+TRIP_OVERVIEW_TEMPLATE = """**Trip Overview:**
+- Destination: %s
+- Travelers: %s
+- Duration: %s
+- Travel Dates: %s
+- Budget: %s
+- Departing From: %s
+- Interests: %s
+- Preferred Pace: %s
+%s"""
+
+DEFAULT_INTERESTS_TEXT = ', '.join(DEFAULT_INTERESTS)
+
+def trip_fields(data):
+    """Extract trip parameters from a validated request body, with defaults"""
+    get = data.get
+    return {
+        "destination": get('destination'),
+        "travelers": get('travelers'),
+        "duration": get('duration'),
+        "dates": get('dates', 'Flexible'),
+        "budget": get('budget', 'Moderate budget'),
+        "departure_city": get('departureCity', 'United States'),
+        "interests": ', '.join(data['interests']) if 'interests' in data else DEFAULT_INTERESTS_TEXT,
+        "pace": get('pace', 'moderate'),
+        "special_requests": get('specialRequests', '')
+    }
+
+def build_request_params(data, trip):
+    """Build the Claude messages request for a trip"""
+    special_requests = trip["special_requests"]
+    trip_overview = TRIP_OVERVIEW_TEMPLATE % (
+        trip["destination"],
+        trip["travelers"],
+        trip["duration"],
+        trip["dates"],
+        trip["budget"],
+        trip["departure_city"],
+        trip["interests"],
+        trip["pace"],
+        "- Special Requests: " + special_requests if special_requests else ""
+    )
+    
+    # Simple trips go to the faster, cheaper model
+    model, max_tokens = choose_model(data)
+    
+    request_params = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": 0.8,  # Slightly creative for variety
+        "system": SYSTEM_BLOCKS,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    DELIVERABLES_BLOCK,
+                    {"type": "text", "text": trip_overview}
+                ]
+            }
+        ]
+    }
+    
+    return request_params
+
+def build_response(trip, itinerary, metadata):
+    """Assemble the public itinerary response"""
+    return {
+        "success": True,
+        "destination": trip["destination"],
+        "itinerary": itinerary,
+        "summary": {
+            "travelers": trip["travelers"],
+            "duration": trip["duration"],
+            "dates": trip["dates"],
+            "budget": trip["budget"],
+            "interests": trip["interests"]
+        },
+        "metadata": metadata
+    }
+
+def generate_itinerary(data):
+    """Generate a complete itinerary with a single blocking Claude call"""
+    trip = trip_fields(data)
+    request_params = build_request_params(data, trip)
+    
+    # No retries: a timed-out blocking call may already have generated (and
+    # billed) the full itinerary, and each retry could wait out the read
+    # timeout again. Callers get a retryable 504 instead.
+    message = client.with_options(max_retries=0).messages.create(**request_params)
+    
+    response = build_response(trip, message.content[0].text, usage_metadata(message.usage, request_params["model"]))
+    cache_itinerary(itinerary_cache_key(data), response)
+    return response
+
+@celery.task(name="generate_itinerary")
+def generate_itinerary_task(data):
+    """Background variant of generate_itinerary for ?async=1 requests"""
+    return generate_itinerary(data)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = clock()
+
+def rate_limited(limiter, cost=1):
+    """Charge the caller's bucket; return a 429 response if it is empty"""
+    retry_after = limiter.take(request.remote_addr, cost)
+    if not retry_after:
+        return None
+    
+    response = error_response(ERR_RATE_LIMITED)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+def log_request_line(method, path, status, started):
+    """Log a finished request if it is a server error or falls in the sample"""
+    if status >= 500 or random.random() < LOG_SAMPLE_RATE:
+        level = logging.WARNING if status >= 500 else logging.INFO
+        logger.log(level, "request", extra={"fields": {
+            "method": method,
+            "path": path,
+            "status": status,
+            "durationMs": round((clock() - started) * 1000, 1)
+        }})
+
+@app.after_request
+def log_request(response):
+    """Log every server error and a sample of other requests"""
+    method, path, started = request.method, request.path, g.request_started
+    outcome = g.get("stream_outcome")
+    
+    if outcome is None:
+        log_request_line(method, path, response.status_code, started)
+    else:
+        # Streamed bodies are generated after this hook runs; log once the
+        # stream closes so duration and in-band failures are accurate
+        response.call_on_close(lambda: log_request_line(method, path, outcome["status"], started))
+    return response
+
+@app.after_request
+def add_cors_headers(response):
+    """Allow any origin with a fixed header set instead of flask-cors matching"""
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.vary.add("Origin")
+    
+    # Preflight: Flask answers OPTIONS automatically for every route
+    if request.method == 'OPTIONS':
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "Content-Type")
+        response.headers["Access-Control-Max-Age"] = "86400"
+    return response
+
+@app.route('/')
+def home():
+    """Health check endpoint"""
+    return jsonify({
+        "status": "online",
+        "service": "AI Travel Planning Agent",
+        "version": "1.0",
+        "endpoints": {
+            "plan_trip": "/api/plan-trip",
+            "plan_trip_status": "/api/plan-trip/<jobId>",
+            "plan_trips_batch": "/api/plan-trips-batch",
+            "plan_trips_batch_status": "/api/plan-trips-batch/<batchId>"
+        }
+    })
+
+@app.route('/api/plan-trip', methods=['POST'])
+def plan_trip():
+    """
+    Generate a custom travel itinerary using Claude AI
+    
+    By default the itinerary is streamed back as NDJSON: one {"delta": "..."}
+    line per text chunk, followed by a final {"metadata": {...}} line.
+    Pass ?stream=0 to get the complete itinerary as a single JSON response,
+    or ?async=1 to queue the job: the 202 response carries a jobId and a
+    statusUrl to poll with GET /api/plan-trip/<jobId>. An async request that
+    hits the cache gets a 200 with the finished-job body instead,
+    {"status": "done", "result": {...}}.
+    
+    Identical requests are answered from the Redis cache when REDIS_URL is
+    configured; set "noCache": true in the body to force a fresh itinerary.
+    Streamed requests use latency-optimized inference when
+    ANTHROPIC_LATENCY_BETA is configured; set "fast": false to opt out.
+    
+    Expected JSON body:
+    {
+        "destination": "Greece",
+        "travelers": "Family of 4 (2 adults, 2 young adults)",
+        "duration": "7 days",
+        "dates": "June 15-22, 2026",
+        "budget": "$8,000-10,000",
+        "departureCity": "Austin, Texas",
+        "interests": ["history", "food", "beaches"],
+        "pace": "relaxed",
+        "specialRequests": "Family-friendly, love culture"
+    }
+    """
+    
+    # Validate request
+    data, error = read_json_body()
+    if error:
+        return error
+    
+    # Validate fields against the compiled schema
+    try:
+        validate_trip_request(data)
+    except fastjsonschema.JsonSchemaException as e:
+        missing_fields = [field for field in REQUIRED_FIELDS if not data.get(field)] if isinstance(data, dict) else []
+        message = f"Missing required fields: {', '.join(missing_fields)}" if missing_fields else f"Invalid request body: {e.message}"
+        return json_response({
+            "error": True,
+            "message": message,
+            "statusCode": 400
+        }, 400)
+    
+    # Serve repeat requests without calling Claude
+    cache_key = itinerary_cache_key(data)
+    cached = None if data.get('noCache') else get_cached_itinerary(cache_key)
+    if cached:
+        cached["metadata"]["cached"] = True
+    
+    if request.args.get('async') == '1':
+        if cached:
+            # Same shape as a finished job from plan_trip_status
+            return json_response({"status": "done", "result": cached})
+        if not REDIS_URL:
+            return error_response(ERR_JOBS_DISABLED)
         
-        # Extract itinerary text
-        itinerary = message.content[0].text
+        limited = rate_limited(rate_limiter)
+        if limited:
+            return limited
         
-        # Calculate cost
-        input_tokens = message.usage.input_tokens
-        output_tokens = message.usage.output_tokens
-        estimated_cost = (input_tokens / 1_000_000 * 3) + (output_tokens / 1_000_000 * 15)
+        try:
+            job = generate_itinerary_task.delay(data)
+        except Exception as e:
+            # Nothing was queued, so the caller keeps the token
+            rate_limiter.refund(request.remote_addr)
+            if not job_service_down(e):
+                raise
+            logger.error("job_enqueue_failed", extra={"fields": {"error": str(e.__cause__ or e)}})
+            return error_response(ERR_JOBS_UNAVAILABLE)
         
-        # Build response
-        response = {
-            "success": True,
-            "destination": destination,
-            "itinerary": itinerary,
-            "summary": {
-                "travelers": travelers,
-                "duration": duration,
-                "dates": dates,
-                "budget": budget,
-                "interests": interests
-            },
-            "metadata": {
-                "generatedAt": datetime.utcnow().isoformat() + "Z",
-                "inputTokens": input_tokens,
-                "outputTokens": output_tokens,
-                "estimatedCost": f"${estimated_cost:.4f}",
-                "model": "claude-sonnet-4-5-20250929"
-            }
-        }
+        return json_response({
+            "jobId": job.id,
+            "statusUrl": url_for('plan_trip_status', job_id=job.id)
+        }, 202)
+    
+    if not cached:
+        limited = rate_limited(rate_limiter)
+        if limited:
+            return limited
+    
+    if request.args.get('stream', '1') != '0':
+        trip = trip_fields(data)
+        request_params = build_request_params(data, trip)
+        model = request_params["model"]
+        
+        # Only interactive streams trade throughput for time-to-first-token;
+        # ?stream=0, queued jobs and batches use the default inference mode
+        if LATENCY_OPTIMIZED_BETA and data.get('fast', True):
+            request_params["extra_headers"] = {"anthropic-beta": LATENCY_OPTIMIZED_BETA}
+        
+        # Status reported in-band by the stream, read by log_request on close
+        outcome = g.stream_outcome = {"status": 200}
         
-        return jsonify(response), 200
+        def generate():
+            if cached:
+                yield orjson.dumps({"delta": cached["itinerary"]}) + b"\n"
+                yield orjson.dumps({"metadata": cached["metadata"]}) + b"\n"
+                return
+            
+            try:
+                chunks = []
+                final = {}
+                # Coalesce token-sized deltas so each socket write carries more text
+                for text in coalesced_text(request_params, final):
+                    chunks.append(text)
+                    yield orjson.dumps({"delta": text}) + b"\n"
+                
+                metadata = usage_metadata(final["message"].usage, model)
+                cache_itinerary(cache_key, build_response(trip, "".join(chunks), metadata))
+                yield orjson.dumps({"metadata": metadata}) + b"\n"
+            except APITimeoutError:
+                # Headers are already sent, so report the failure in-band
+                outcome["status"] = 504
+                yield ERR_TIMEOUT[0] + b"\n"
+            except Exception as e:
+                outcome["status"] = 500
+                logger.error("itinerary_failed", extra={"fields": {"error": str(e)}})
+                yield orjson.dumps({
+                    "error": True,
+                    "message": f"Error generating itinerary: {str(e)}",
+                    "statusCode": 500
+                }) + b"\n"
         
+        body = generate()
+        headers = {"Vary": "Accept-Encoding"}
+        if request.accept_encodings["gzip"]:
+            body = gzip_stream(body)
+            headers["Content-Encoding"] = "gzip"
+        
+        return Response(stream_with_context(body), mimetype="application/x-ndjson", headers=headers)
+    
+    if cached:
+        return json_response(cached)
+    
+    try:
+        return json_response(generate_itinerary(data))
+        
+    except APITimeoutError:
+        return error_response(ERR_TIMEOUT)
     except Exception as e:
-        return jsonify({
+        logger.error("itinerary_failed", extra={"fields": {"error": str(e)}})
+        return json_response({
             "error": True,
             "message": f"Error generating itinerary: {str(e)}",
             "statusCode": 500
-        }), 500
+        }, 500)
 
-@app.errorhandler(404)
-def not_found(e):
-    return jsonify({
+@app.route('/api/plan-trip/<job_id>', methods=['GET'])
+def plan_trip_status(job_id):
+    """Report the status of a job queued with POST /api/plan-trip?async=1"""
+    if not REDIS_URL:
+        return error_response(ERR_JOBS_DISABLED)
+    
+    job = celery.AsyncResult(job_id)
+    
+    try:
+        if job.successful():
+            return json_response({"status": "done", "result": job.result})
+        if job.failed():
+            return json_response({
+                "status": "failed",
+                "message": f"Error generating itinerary: {str(job.result)}"
+            })
+    except Exception as e:
+        if not job_service_down(e):
+            raise
+        logger.error("job_status_failed", extra={"fields": {"error": str(e.__cause__ or e)}})
+        return error_response(ERR_JOBS_UNAVAILABLE)
+    
+    # Celery reports unknown ids as PENDING too
+    return json_response({"status": "pending"})
+
+@app.route('/api/plan-trips-batch', methods=['POST'])
+def plan_trips_batch():
+    """
+    Queue many itineraries at once through the Message Batches API
+    
+    Takes a JSON array of plan-trip bodies (at most MAX_BATCH_SIZE) and
+    returns a batchId; results are keyed by each trip's index in the array.
+    Batches are billed at half price but may take minutes to hours to
+    finish - use this for bulk, non-interactive callers. Requires REDIS_URL,
+    where the ids of created batches are recorded.
+    """
+    if redis_client is None:
+        return error_response(ERR_BATCHES_DISABLED)
+    
+    data, error = read_json_body()
+    if error:
+        return error
+    
+    try:
+        validate_batch_request(data)
+    except fastjsonschema.JsonSchemaException as e:
+        return json_response({
+            "error": True,
+            "message": f"Invalid request body: {e.message}",
+            "statusCode": 400
+        }, 400)
+    
+    if 0 < batch_rate_limiter.capacity < len(data):
+        return json_response({
+            "error": True,
+            "message": f"Batch exceeds the limit of {batch_rate_limiter.capacity} trips per minute",
+            "statusCode": 400
+        }, 400)
+    
+    limited = rate_limited(batch_rate_limiter, len(data))
+    if limited:
+        return limited
+    
+    batch_requests = []
+    for index, trip_data in enumerate(data):
+        params = build_request_params(trip_data, trip_fields(trip_data))
+        batch_requests.append({"custom_id": str(index), "params": params})
+    
+    try:
+        batch = client.messages.batches.create(requests=batch_requests)
+    except Exception as e:
+        return json_response({
+            "error": True,
+            "message": f"Error creating batch: {str(e)}",
+            "statusCode": 500
+        }, 500)
+    
+    try:
+        redis_client.setex(BATCH_KEY_PREFIX + batch.id, BATCH_RECORD_TTL, 1)
+    except redis.RedisError as e:
+        logger.error("batch_record_failed", extra={"fields": {"batchId": batch.id, "error": str(e)}})
+        # Unrecorded results could never be read back, so don't pay for them
+        try:
+            client.messages.batches.cancel(batch.id)
+        except Exception:
+            pass
+        batch_rate_limiter.refund(request.remote_addr, len(data))
+        return error_response(ERR_JOBS_UNAVAILABLE)
+    
+    return json_response({
+        "batchId": batch.id,
+        "statusUrl": url_for('plan_trips_batch_status', batch_id=batch.id)
+    }, 202)
+
+def batch_not_found(batch_id):
+    """404 for batches that don't exist or weren't created by this service"""
+    return json_response({
         "error": True,
-        "message": "Endpoint not found. Use POST /api/plan-trip",
+        "message": f"Batch not found: {batch_id}",
         "statusCode": 404
-    }), 404
+    }, 404)
+
+@app.route('/api/plan-trips-batch/<batch_id>', methods=['GET'])
+def plan_trips_batch_status(batch_id):
+    """Report progress of a batch, with per-trip results once it has ended"""
+    if redis_client is None:
+        return error_response(ERR_BATCHES_DISABLED)
+    
+    try:
+        issued = redis_client.exists(BATCH_KEY_PREFIX + batch_id)
+    except redis.RedisError as e:
+        logger.error("batch_status_failed", extra={"fields": {"error": str(e)}})
+        return error_response(ERR_JOBS_UNAVAILABLE)
+    
+    # Only batches created through this service are visible
+    if not issued:
+        return batch_not_found(batch_id)
+    
+    try:
+        batch = client.messages.batches.retrieve(batch_id)
+        
+        if batch.processing_status != "ended":
+            return json_response({
+                "status": "pending",
+                "requestCounts": batch.request_counts.model_dump()
+            })
+        
+        # Stamp results with when the batch finished, not when it was polled
+        ended_at = iso_utc(batch.ended_at.utctimetuple())
+        
+        results = {}
+        for entry in client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                results[entry.custom_id] = {
+                    "success": True,
+                    "itinerary": message.content[0].text,
+                    "metadata": usage_metadata(message.usage, message.model, batch=True, generated_at=ended_at)
+                }
+            else:
+                results[entry.custom_id] = {
+                    "error": True,
+                    "message": f"Itinerary request {entry.result.type}"
+                }
+    except NotFoundError:
+        return batch_not_found(batch_id)
+    except Exception as e:
+        return json_response({
+            "error": True,
+            "message": f"Error retrieving batch: {str(e)}",
+            "statusCode": 500
+        }, 500)
+    
+    return json_response({"status": "done", "results": results})
+
+@app.errorhandler(404)
+def not_found(e):
+    return error_response(ERR_NOT_FOUND)
 
 @app.errorhandler(405)
 def method_not_allowed(e):
-    return jsonify({
-        "error": True,
-        "message": "Method not allowed. Use POST request.",
-        "statusCode": 405
-    }), 405
+    return error_response(ERR_METHOD_NOT_ALLOWED)
 
 if __name__ == '__main__':
+    # Local development only - the Werkzeug server handles one request at a
+    # time. In production run: gunicorn -c gunicorn_conf.py travel_agent_api:app
     if not os.environ.get("ANTHROPIC_API_KEY"):
         print("WARNING: ANTHROPIC_API_KEY environment variable not set!")
     